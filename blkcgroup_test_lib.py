@@ -30,7 +30,9 @@
 #      Do more testing on non fakenuma systems
 
 
-import getopt, glob, logging, os, re, subprocess, sys, time, traceback, math
+import ctypes, errno
+import getopt, glob, logging, os, re, shutil, signal, subprocess, sys
+import tempfile, threading, time, traceback, math
 import cgroup, cpuset, error, utils
 
 # Size of allocated containers for workers. We chose 360mb because it's small
@@ -44,10 +46,35 @@ MAX_VALID_WEIGHT = 1000 # kernel limits the max value to be 1000 (min to 100)
 
 TEST_CGROUP_PREFIX = 'blkcgroupt'
 
+# When stopping experiments at steady state, service times are sampled every
+# STEADY_STATE_INTERVAL seconds, and achieved weights may drift by at most
+# STEADY_STATE_TOLERANCE over the steady state period.
+STEADY_STATE_INTERVAL = 1.0
+STEADY_STATE_TOLERANCE = 10
+
 # Keyed off the value of google_hacks. We set this to 'io' internally.
 # TODO(teravest): Set this up from kernel version instead.
 BLKIO_CGROUP_NAME = 'io'
 
+# The C library, for file calls that python's os module lacks.
+libc = ctypes.CDLL('libc.so.6', use_errno=True)
+# From <fcntl.h>: 4 on x86, arm and most other arches, but 6 on s390x.
+POSIX_FADV_DONTNEED = 6 if os.uname()[4] == 's390x' else 4
+
+# Cache of the block device holding each queried file.
+cached_devices = {}
+
+# Devices already checked to be using the cfq scheduler.
+cfq_enabled_devices = set()
+
+# Tokens of the experiment grammar.
+_SPACE_RE = re.compile(r'\s*')
+_INT_RE = re.compile(r'\d*')
+_NAME_RE = re.compile(r'[^ ,*%();]*')
+
+# One megabyte of zeros, reused for every block written by zero_fill_file().
+ZERO_MBYTE = '\0' * (1 << 20)
+
 def usage(argv):
     """Prints usage information to stderr."""
     sys.stderr.write('%s [-cgh] [-o file]: Runs a blkcgroup isolation test\n'
@@ -86,36 +113,39 @@ def setup_logging(debug=False):
         logging.getLogger().setLevel(logging.INFO)
 
 
-def expect_delim(text, delim):
-    """Require text to start with delim, and return text with delim stripped.
+def expect_delim(text, pos, delim):
+    """Require text to have delim at pos, and return the position after it.
     """
-    if text[0] != delim:
-        raise ValueError, 'missing %s at %s' % (delim, text)
-    return text[1:]
+    if text[pos] != delim:
+        raise ValueError, 'missing %s at %s' % (delim, text[pos:])
+    return pos + 1
+
+def skip_space(text, pos):
+    """Return the position of the first non-blank character from pos on."""
+    return _SPACE_RE.match(text, pos).end()
 
-def parse_integer(text):
-    """Split a string, parsing off the integer at the beginning.
+def parse_integer(text, pos):
+    """Parse off the integer at pos in a string.
 
-    For example, '90% rdseq, 10% seq' becomes (90, '% rdseq, 10% seq')
+    For example, ('90% rdseq, 10% seq', 0) becomes (90, 2)
     """
-    value = re.match('\d*', text).group()
-    return int(value), text[len(value):]
+    m = _INT_RE.match(text, pos)
+    return int(m.group()), m.end()
 
-def parse_container(text):
-    """Split a string, parsing off the integer at the beginning along
-    with an optional P/p flag to indicate that the group should be
-    high priority.
+def parse_container(text, pos):
+    """Parse off the integer at pos in a string along with an optional
+    P/p flag to indicate that the group should be high priority.
 
-    For example, '90% rdseq, 10% seq' becomes (90, 2, '% rdseq, 10% seq')
-                 '90p% rdseq, 10% seq' becomes (90, 1, '% rdseq, 10% seq')
+    For example, ('90% rdseq, 10% seq', 0) becomes (<weight 90, prio 2>, 2)
+                 ('90p% rdseq, 10% seq', 0) becomes (<weight 90, prio 1>, 3)
     """
-    weight, text = parse_integer(text)
-    if text.startswith('P') or text.startswith('p'):
+    weight, pos = parse_integer(text, pos)
+    if text.startswith(('P', 'p'), pos):
         priority = 1
-        text = text[1:]
+        pos += 1
     else:
         priority = 2
-    if text.startswith('S') or text.startswith('s'):
+    if text.startswith(('S', 's'), pos):
         shared_sync_queues = True
     else:
         shared_sync_queues = False
@@ -123,53 +153,53 @@ def parse_container(text):
         'weight': weight,
         'priority': priority,
         'shared_sync_queues': shared_sync_queues
-    }, text
+    }, pos
 
-def parse_name(text):
-    """Split an arbitrary (maybe empty) word from the beginning of a string."""
-    lth = 0
-    while text[lth] not in ' ,*%();':
-        lth += 1
-    return text[:lth], text[lth:]
+def parse_name(text, pos):
+    """Parse an arbitrary (maybe empty) word starting at pos in a string."""
+    m = _NAME_RE.match(text, pos)
+    return m.group(), m.end()
 
 
-def parse_containers(text):
-    """Parse worker containers in an experiment."""
+def parse_containers(text, pos):
+    """Parse worker containers in an experiment, starting at pos."""
     containers = []
     while True:
-        container, text = parse_container(text.lstrip())
-        options, text = parse_name(text)
+        container, pos = parse_container(text, skip_space(text, pos))
+        options, pos = parse_name(text, pos)
         # This is where we would hook in options for limiting.
 
-        worker, text = parse_name(text.lstrip())
+        worker, pos = parse_name(text, skip_space(text, pos))
         repeat = 0
         if worker:
             repeat = 1
-            if text[0] == '*':
-                repeat, text = parse_integer(text[1:])
-            text = text.lstrip()
+            if text[pos] == '*':
+                repeat, pos = parse_integer(text, pos + 1)
+            pos = skip_space(text, pos)
             container['worker'] = worker
         container['worker_repeat'] = repeat
 
         # Parse the containers within the nested group.
         # We only support one level of nesting.
         inner = []
-        if text[0] == '(':
-            inner, text = parse_containers(text[1:])
-            text = expect_delim(text.lstrip(), ')').lstrip()
+        if text[pos] == '(':
+            inner, pos = parse_containers(text, pos + 1)
+            pos = expect_delim(text, skip_space(text, pos), ')')
+            pos = skip_space(text, pos)
         container['nest'] = inner
 
         containers.append(container)
-        if text[0] != ',':
+        if text[pos] != ',':
             break
-        text = text[1:]
-    return containers, text
+        pos += 1
+    return containers, pos
 
 
 def parse_experiment(text):
     """Parse an experiment and require that all input is consumed."""
-    exper, text = parse_containers(text + ';')
-    text = expect_delim(text, ';')
+    text += ';'
+    exper, pos = parse_containers(text, 0)
+    expect_delim(text, pos, ';')
     return exper
 
 
@@ -226,30 +256,68 @@ def setup_containers(tree, device,
        needed for one experiment.  my_*_parent describe the existing cpu
        cgroup and io cgroup of this subtree's parent container.
     """
-    for i, container in enumerate(tree):
-        # Create next sibling container at this level
-        setup_container(container, '%s%d' % (TEST_CGROUP_PREFIX, i), device,
-                        root_name, my_cpu_parent, my_blkio_parent)
+    # Siblings don't depend on each other, so create all containers at this
+    # level concurrently. Each one is a handful of mkdirs and cgroup file
+    # writes, which release the GIL. cpuset discovers its container style
+    # lazily into globals, so do that once before any thread can race on it.
+    cpuset.discover_container_style()
+    failures = []
+    def create_sibling(i, container):
+        try:
+            setup_container(container, '%s%d' % (TEST_CGROUP_PREFIX, i),
+                            device, root_name, my_cpu_parent, my_blkio_parent)
+        except Exception:
+            failures.append(sys.exc_info())
+
+    threads = [threading.Thread(target=create_sibling, args=(i, container))
+               for i, container in enumerate(tree)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if failures:
+        exc_type, exc_value, exc_tb = failures[0]
+        raise exc_type, exc_value, exc_tb
 
+    for container in tree:
         setup_containers(container['nest'], device,
                          root_name, container['cpu_cgroup'],
                          container['blkio_cgroup'])
 
 
+def device_stats(blkio_cgroup, attr, device):
+    """Returns the split lines of a per-device blkio attribute for device.
+
+    Lines for other devices are skipped without being split.
+    """
+    stats = []
+    for line in blkio_cgroup.get_attr(attr):
+        if line.startswith(device):
+            parts = line.split()
+            if parts[0] == device:
+                stats.append(parts)
+    return stats
+
+
+def service_time(blkio_cgroup, device):
+    """Get the total io_service_time of a cgroup for device, or None."""
+    total = None
+    for parts in device_stats(blkio_cgroup, 'io_service_time', device):
+        if parts[1] == 'Total':
+            total = int(parts[-1])
+    return total
+
+
 def measure_containers(tree, device, timevals):
     """Measures the 'time' attribute for all containers for a given device.
 
     """
     for container in tree:
-        found_data = False
-        for line in container['blkio_cgroup'].get_attr('io_service_time'):
-            parts = line.split()
-            if parts[0] == device and parts[1] == 'Total':
-                timevals[container['name']] = int(parts[-1])
-                found_data = True
-        if not found_data:
-            timevals[container['name']] = 0
+        total = service_time(container['blkio_cgroup'], device)
+        if total is None:
+            total = 0
             logging.warn('No data for container %s.' % container['name'])
+        timevals[container['name']] = total
 
         # Recurse to nested containers.
         measure_containers(container['nest'], device, timevals)
@@ -265,19 +333,17 @@ def measure_timeslice_used(tree, device, timevals):
     """
     for container in tree:
         found_data = False
-        for line in container['blkio_cgroup'].get_attr('timeslice_used'):
-            parts = line.split()
-            if parts[0] == device:
-                timevals[container['name']] = int(parts[-1])
-                found_data = True
+        for parts in device_stats(container['blkio_cgroup'],
+                                  'timeslice_used', device):
+            timevals[container['name']] = int(parts[-1])
+            found_data = True
         if not found_data:
             timevals[container['name']] = 0
             logging.warn('No data for container %s.' % container['name'])
 
-        for line in container['blkio_cgroup'].get_attr('unaccounted_time'):
-            parts = line.split()
-            if parts[0] == device:
-                timevals[container['name']] -= int(parts[-1])
+        for parts in device_stats(container['blkio_cgroup'],
+                                  'unaccounted_time', device):
+            timevals[container['name']] -= int(parts[-1])
 
         # Recurse to nested containers.
         measure_timeslice_used(container['nest'], device, timevals)
@@ -288,9 +354,8 @@ def get_io_service_bytes(container, device):
         given container.
     """
     total = 0
-    for line in container.get_attr('io_service_bytes'):
-        parts = line.split()
-        if parts[0] == device and parts[1] == 'Total':
+    for parts in device_stats(container, 'io_service_bytes', device):
+        if parts[1] == 'Total':
             total = float(parts[2])
     return total
 
@@ -308,34 +373,110 @@ def remove_file(file):
         os.remove(file)
 
 
+def achieved_weights(times, weights):
+    """Returns the weights that sibling containers achieved, scaling their
+    share of the total time to their total weight.
+    """
+    total_time = sum(times) or 1
+    total_weight = sum(weights)
+    return [time * total_weight / total_time for time in times]
+
+
+class experiment_arrays(object):
+    """Flat, parallel lists describing all containers of an experiment.
+
+    Built once after the containers are set up, so code that repeatedly
+    samples every container does not walk the tree of container dicts.
+    Parents come before their nested containers.
+    """
+    __slots__ = ('names', 'weights', 'blkio_cgroups', 'sibling_groups')
+
+    def __init__(self, tree):
+        self.names = []
+        self.weights = []
+        self.blkio_cgroups = []
+        self.sibling_groups = []  # index lists of containers sharing a parent
+        self._add_siblings(tree)
+
+
+    def _add_siblings(self, tree):
+        first = len(self.names)
+        for container in tree:
+            self.names.append(container['name'])
+            self.weights.append(int(container['weight']))
+            self.blkio_cgroups.append(container['blkio_cgroup'])
+        if tree:
+            self.sibling_groups.append(range(first, len(self.names)))
+        for container in tree:
+            self._add_siblings(container['nest'])
+
+
+    def measure(self, device):
+        """Get the service time of every container for device."""
+        return [service_time(blkio_cgroup, device) or 0
+                for blkio_cgroup in self.blkio_cgroups]
+
+
+    def achieved_weights(self, times):
+        """Get the weight every container achieved, given its service time."""
+        actual = [0] * len(times)
+        for group in self.sibling_groups:
+            group_weights = achieved_weights([times[i] for i in group],
+                                             [self.weights[i] for i in group])
+            for i, weight in zip(group, group_weights):
+                actual[i] = weight
+        return actual
+
+
+def wait_for_steady_state(arrays, device, steady_state_secs, stop):
+    """Wait until the achieved weights of all containers in arrays have stayed
+       within STEADY_STATE_TOLERANCE for steady_state_secs seconds.
+       Returns True once they have, or False if the stop event got set first.
+    """
+    samples = []
+    while not stop.wait(STEADY_STATE_INTERVAL):
+        times = arrays.measure(device)
+        if not sum(times):
+            continue  # no IO serviced yet
+        now = time.time()
+        samples.append((now, arrays.achieved_weights(times)))
+
+        # Keep every sample of the window, starting from the newest sample
+        # that is at least steady_state_secs old.
+        while len(samples) > 1 and samples[1][0] <= now - steady_state_secs:
+            samples.pop(0)
+        if now - samples[0][0] < steady_state_secs:
+            continue
+        # Each container's weight must have stayed in range over the window.
+        drift = max([max(weights) - min(weights) for weights
+                     in zip(*[sample[1] for sample in samples])])
+        if drift <= STEADY_STATE_TOLERANCE:
+            return True
+    return False
+
+
 def score_max_error(tree, timevals):
     """Find maximum DTF error across containers of tree, and achieved DTFs
     """
-    total_time = 0
-    total_weight = 0
-    for container in tree:
-        total_time += timevals[container['name']]
-        total_weight += container['weight']
-    actual_weights_str = ''
-    maxerr = 0
-
-    for container in tree:
-        # Calculate error.
-        logging.debug('Calculate the max error for the experiment.')
-        time = timevals[container['name']]
-        actual_weight = time * total_weight / (total_time or 1)
-        actual_weights_str += '%d' % actual_weight
-        error = abs(actual_weight - int(container['weight']))
-        maxerr = max(maxerr, error)
+    # Calculate error for all siblings in one pass over flat lists.
+    logging.debug('Calculate the max error for the experiment.')
+    times = [timevals[container['name']] for container in tree]
+    weights = [int(container['weight']) for container in tree]
+    actual_weights = achieved_weights(times, weights)
+    maxerr = max([abs(actual - weight)
+                  for actual, weight in zip(actual_weights, weights)] or [0])
+
+    parts = []
+    for container, actual_weight in zip(tree, actual_weights):
+        part = '%d' % actual_weight
 
         error, inner_w = score_max_error(container['nest'], timevals)
         if inner_w:
-          actual_weights_str += ' [%s]' % inner_w
-        actual_weights_str += ', '
+          part += ' [%s]' % inner_w
+        parts.append(part)
         maxerr = max(maxerr, error)
 
-    actual_weights_str = actual_weights_str[:-2]  # Clip off last ', '
-    return maxerr, actual_weights_str
+    return maxerr, ', '.join(parts)
 
 
 def score_experiment(exper_num, experiment, exper, timevals, allowed_err,
@@ -371,32 +512,53 @@ def kill_slower_workers(fast_pid, cpu_cgroup, pids_file):
     logging.debug('fastest worker pid %d of container %s'
                   ' killing all slower workers',
                   fast_pid, cpu_cgroup.path)
-    for line in open(moved_pids_file):
-        pid = int(line.rstrip())
+    with open(moved_pids_file) as f:
+        pids = [int(line) for line in f if line.strip()]
+    for pid in pids:
         if pid != fast_pid:
-            utils.system('kill %d' % pid, ignore_status=True)
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass  # worker already exited
+
 
+def start_worker(cmd, cpu_cgroup, blkio_cgroup, pids_file):
+    """Launch one independent worker command inside its containers.
 
-def run_worker(cmd, cpu_cgroup, blkio_cgroup, pids_file):
-    # main of new process for running an independent worker shell
+    The forked child moves itself into cpu_cgroup and blkio_cgroup before
+    exec'ing cmd, so no intermediate python process is needed. Returns the
+    Popen object and the temporary file collecting the worker's output.
+    """
     logging.debug('Worker running command: %s' % cmd)
     logging.debug('Moving to cpu_cgroup: %s' % cpu_cgroup.path)
     logging.debug('Moving to blkio_cgroup: %s' % blkio_cgroup.path)
-    cpu_cgroup.move_my_task_here()
-    blkio_cgroup.move_my_task_here()
+    tasks_files = [os.path.join(cpu_cgroup.path, 'tasks'),
+                   os.path.join(blkio_cgroup.path, 'tasks')]
+    def move_to_containers():
+        # Runs in the forked child, so keep it to bare writes of its pid.
+        pid = '%d\n' % os.getpid()
+        for tasks_file in tasks_files:
+            fd = os.open(tasks_file, os.O_WRONLY)
+            try:
+                os.write(fd, pid)
+            finally:
+                os.close(fd)
+    output = tempfile.TemporaryFile()
     p = subprocess.Popen(cmd.split(),
-                         stdout=subprocess.PIPE,
+                         stdout=output,
                          stderr=subprocess.STDOUT,
-                         close_fds=True)
+                         close_fds=True,
+                         preexec_fn=move_to_containers)
     if pids_file:
-        utils.system('echo %d >> %s' % (p.pid, pids_file))
+        # O_APPEND keeps concurrent appends from sibling workers intact.
+        fd = os.open(pids_file, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0644)
+        try:
+            os.write(fd, '%d\n' % p.pid)
+        finally:
+            os.close(fd)
     logging.debug('running "%s" in container %s and io cgroup %s as pid %d',
                   cmd, cpu_cgroup.path, blkio_cgroup.path, p.pid)
-
-    p.wait()
-    if pids_file:
-        kill_slower_workers(p.pid, cpu_cgroup, pids_file)
-    logging.debug(p.stdout.read())
+    return p, output
 
 
 def actual_disk_device(ldevice):
@@ -413,25 +575,98 @@ def actual_disk_device(ldevice):
 
 
 def device_holding_file(filename):
-    mountpoint = os.path.abspath(filename)
+    if filename in cached_devices:
+        return cached_devices[filename]
+
+    # Map every mount point to the device mounted there. Later entries
+    # are mounted over earlier ones, so they win.
+    mounts = {}
+    with open('/proc/mounts') as f:
+        for line in f:
+            parts = line.split(None, 2)
+            # The kernel octal-escapes blanks and backslashes, eg '\040'.
+            mounts[parts[1].decode('string_escape')] = parts[0]
 
     # Iterate over the path until we get the mount point.
-    while not os.path.ismount(mountpoint):
-        mountpoint = os.path.dirname(mountpoint)
+    mountpoint = os.path.abspath(filename)
+    while mountpoint not in mounts:
+        parent = os.path.dirname(mountpoint)
+        if parent == mountpoint:
+            # Reached / without a mount, e.g. inside a chroot.
+            raise ValueError("Could not find device holding %s" % filename)
+        mountpoint = parent
+
+    if not mounts[mountpoint].startswith('/dev/'):
+        raise ValueError("Could not find device holding %s" % filename)
+    # Partition = everythin beyond /dev/
+    partition = mounts[mountpoint][5:]
+    device = partition.rstrip('0123456789')
+    cached_devices[filename] = device
+    return device
+
+
+def preallocate_file(fd, offset, length):
+    """Reserve disk blocks for a file region with fallocate.
+
+    Unlike posix_fallocate, this never falls back to writing every block
+    when the filesystem cannot preallocate. Returns 0 on success, else the
+    errno, e.g. EOPNOTSUPP.
+    """
+    try:
+        fallocate = libc.fallocate64
+    except AttributeError:
+        return errno.ENOSYS
+    if fallocate(fd, 0, ctypes.c_int64(offset), ctypes.c_int64(length)):
+        return ctypes.get_errno()
+    return 0
 
-    # Parse all the mount points and return the underlying device.
-    for line in open('/proc/mounts').readlines():
-        parts = line.split()
-        if parts[0].startswith('/dev/') and parts[1] == mountpoint:
-            # Partition = everythin beyond /dev/
-            partition = parts[0][5:]
-            device = partition.rstrip('0123456789')
-            return device
-    raise ValueError("Could not find device holding %s" % filename)
+
+def drop_file_cache(name):
+    """Write back and evict the page cache of a single file.
+
+    Raises OSError if the cached pages could not be dropped.
+    """
+    fd = os.open(name, os.O_RDONLY)
+    try:
+        os.fdatasync(fd)
+        err = libc.posix_fadvise64(fd, ctypes.c_int64(0), ctypes.c_int64(0),
+                                   POSIX_FADV_DONTNEED)
+    finally:
+        os.close(fd)
+    if err:
+        raise OSError(err, os.strerror(err), name)
+
+
+def zero_fill_file(name, old_mbytes, mbytes):
+    """Extend file name with zeros from old_mbytes up to mbytes.
+
+    Writes in-process from one shared zero buffer, rather than forking a dd.
+    The new region is preallocated first so it is laid out contiguously.
+    The zeros must still be written: unwritten extents read back as zeros
+    without any disk IO, which would leave the read workers idle.
+    """
+    fd = os.open(name, os.O_WRONLY | os.O_CREAT, 0644)
+    try:
+        err = preallocate_file(fd, old_mbytes << 20,
+                               (mbytes - old_mbytes) << 20)
+        if err:
+            logging.debug('Could not preallocate %s: %s',
+                          name, os.strerror(err))
+        os.lseek(fd, old_mbytes << 20, os.SEEK_SET)
+        for i in xrange(mbytes - old_mbytes):
+            # Retry short writes; a full disk then raises ENOSPC here.
+            written = 0
+            while written < len(ZERO_MBYTE):
+                written += os.write(fd, buffer(ZERO_MBYTE, written))
+    finally:
+        os.close(fd)
 
 
 def enable_blkio_and_cfq(device):
     """Enable blkio and cfq, when not done by boot command."""
+    if device in cfq_enabled_devices:
+        return
+
     # Ensure that the required device is valid block device.
     disk = os.path.join('/sys/block', device)
     if not os.path.exists(disk):
@@ -445,10 +680,10 @@ def enable_blkio_and_cfq(device):
     file = os.path.join(disk, 'queue/scheduler')
     if '[cfq]' in utils.read_one_line(file):
         logging.debug('cfq scheduler is already enabled on drive %s', device)
-        return
-
-    logging.info('Enabling cfq scheduler on drive %s', device)
-    utils.write_one_line(file, 'cfq')
+    else:
+        logging.info('Enabling cfq scheduler on drive %s', device)
+        utils.write_one_line(file, 'cfq')
+    cfq_enabled_devices.add(device)
 
 
 
@@ -465,9 +700,7 @@ class test_harness(object):
         # TODO: use actual disk file size, avoid rebuilding across iterations
         old_mbytes = self.existing_input_files.get(name, 0)
         if mbytes > old_mbytes:
-            cmd = ('/bin/dd if=/dev/zero of=%s bs=1M seek=%d count=%d'
-                   % (name, old_mbytes, mbytes-old_mbytes))
-            utils.system(cmd)
+            zero_fill_file(name, old_mbytes, mbytes)
             self.existing_input_files[name] = mbytes
         return name
 
@@ -532,6 +765,10 @@ class test_harness(object):
         elif worker.startswith('wrseq'):
             file_name = self.some_output_file()
             extra_options = ''
+            # Writes through the page cache are reshaped by writeback, so
+            # they use large blocks to cut dd's syscalls. Direct writes keep
+            # 64K blocks since those set the size of each disk IO.
+            block_kbytes = 1024
 
             if variant == 'sync':
                 # Compensate for slower rate.
@@ -539,13 +776,14 @@ class test_harness(object):
                 extra_options += 'conv=fdatasync '
             elif variant == 'dir':
                 extra_options += 'oflag=direct '
+                block_kbytes = 64
             else:
                 # Buffered mode needs a bigger files which overflow fs cache.
                 mbytes *= 2
 
-            count = mbytes * 16  # 64K * 16 = 1M
-            cmd = ('/bin/dd if=/dev/zero of=%s bs=64K count=%d %s' %
-                   (file_name, count, extra_options))
+            count = (mbytes << 10) // block_kbytes
+            cmd = ('/bin/dd if=/dev/zero of=%s bs=%dK count=%d %s' %
+                   (file_name, block_kbytes, count, extra_options))
 
         elif worker.startswith('io_load_read'):
             io_load_path = os.path.join(self.srcdir, 'io_load')
@@ -627,39 +865,84 @@ class test_harness(object):
         return tasks
 
 
-    def run_worker_processes_in_parallel(self, runners):
+    def run_worker_processes_in_parallel(self, runners, arrays=None,
+                                         steady_state_secs=0):
+        """Launch all workers and wait for them to finish.
+
+        With steady_state_secs set, all workers are also stopped as soon as
+        the achieved weights of the containers in arrays, an
+        experiment_arrays, have been steady for that many seconds.
+        """
+        if steady_state_secs and arrays is None:
+            raise ValueError('steady_state_secs needs the experiment_arrays '
+                             'of the containers to monitor')
         sys.stdout.flush()
         sys.stderr.flush()
-        pids = []
+        workers = {}
         for task in runners:
             args = task
             logging.debug('running worker args: %s' % args)
-            pid = os.fork()
-            if not pid:  # we are child process
-                try:
-                    run_worker(*args)
-                except Exception, e:
-                    exc_type, exc_value, exc_tb = sys.exc_info()
-                    logging.error("*** Traceback:")
-
-                    for line in traceback.format_exception(
-                        exc_type, exc_value, exc_tb):
-                        logging.error(line)
-
-                    logging.error('child ended by exception %s', e)
-                    sys.exit(1)
-                sys.exit(0)
-            # we are parent
-            pids.append(pid)
+            try:
+                p, output = start_worker(*args)
+            except Exception, e:
+                exc_type, exc_value, exc_tb = sys.exc_info()
+                logging.error("*** Traceback:")
+
+                for line in traceback.format_exception(
+                    exc_type, exc_value, exc_tb):
+                    logging.error(line)
+
+                logging.error('worker ended by exception %s', e)
+                continue
+            # Holding p keeps subprocess from reaping it behind os.wait().
+            workers[p.pid] = (p, output, args)
+
+        # Keeps the monitor from iterating workers while the reap loop pops
+        # from it. A pid that os.wait() reaped but that is not yet popped
+        # can still be signalled; kill_slower_workers has the same window.
+        workers_lock = threading.Lock()
+        stop = threading.Event()
+        def stop_workers_at_steady_state():
+            if not wait_for_steady_state(arrays, self.device,
+                                         steady_state_secs, stop):
+                return
+            logging.info('Achieved weights steady for %d seconds, stopping '
+                         'all workers.', steady_state_secs)
+            with workers_lock:
+                for pid in workers:
+                    try:
+                        os.kill(pid, signal.SIGTERM)
+                    except OSError:
+                        pass  # worker already exited
+
+        if steady_state_secs:
+            monitor = threading.Thread(target=stop_workers_at_steady_state)
+            monitor.start()
 
         logging.debug('waiting for worker tasks')
-        for pid in pids:
-            pid, status = os.waitpid(pid, 0)
+        try:
+            while workers:
+                pid, status = os.wait()
+                with workers_lock:
+                    if pid not in workers:
+                        continue
+                    p, output, (cmd, cpu_cgroup, blkio_cgroup, pids_file) = \
+                        workers.pop(pid)
+                if pids_file:
+                    kill_slower_workers(pid, cpu_cgroup, pids_file)
+                output.seek(0)
+                logging.debug(output.read())
+                output.close()
+        finally:
+            if steady_state_secs:
+                stop.set()
+                monitor.join()
 
 
     def run_single_experiment(self, exper_num, experiment, seq_read_mb,
                               kill_slower, timeout, allowed_error,
-                              autotest_data):
+                              autotest_data, full_cache_flush,
+                              steady_state_secs):
         """Run a single experiment involving one round of concurrent execution
            of IO workers in competing containers.
         """
@@ -680,8 +963,14 @@ class test_harness(object):
         else:
             pids_file = ''
 
-        logging.info('Flush all read/write caches. This could take a minute.')
-        utils.drop_caches()
+        if full_cache_flush:
+            logging.info('Flush all read/write caches. '
+                         'This could take a minute.')
+            utils.drop_caches()
+        else:
+            logging.info('Flush cached pages of the input files.')
+            for name in self.existing_input_files:
+                drop_file_cache(name)
 
         # Generate class cgroup_access objects or cpuset and blkio.
         parent_cpu_cgroup = cgroup.root_cgroup('cpuset')
@@ -701,7 +990,12 @@ class test_harness(object):
                      'processes.')
         start_seconds = time.time()
         start_bytes = get_io_service_bytes(parent_blkio_cgroup, self.device)
-        self.run_worker_processes_in_parallel(runners)
+        # The flat container lists only feed the steady state monitor.
+        arrays = None
+        if steady_state_secs:
+            arrays = experiment_arrays(exper)
+        self.run_worker_processes_in_parallel(runners, arrays,
+                                              steady_state_secs)
 
         logging.info('All workers have now completed or been killed by fastest '
                      'worker.')
@@ -745,7 +1039,8 @@ class test_harness(object):
 
 
     def run_experiments(self, experiments, seq_read_mb, workvol,
-                        kill_slower=False, timeout=''):
+                        kill_slower=False, timeout='', full_cache_flush=True,
+                        steady_state_secs=0):
         """Execute a previously-generated list of experiments.
 
         experiments: a list of (string, number) tuples to run as tests.
@@ -762,6 +1057,13 @@ class test_harness(object):
             Keeps 25_25_25_25% experiment from taking 4x longer than 95_5%.
             This should be set longer than most experiments, and long enough
             to reach steady state and good measurements on all experiments.
+        full_cache_flush: drop the whole system page cache before each
+            experiment. When False, only the pages of the input files are
+            written back and evicted, leaving unrelated cached data alone.
+        steady_state_secs = 0: run workers until they finish or time out
+        steady_state_secs = 30: also stop all workers once the achieved
+            weights of every container have stayed within
+            STEADY_STATE_TOLERANCE for 30 seconds.
         """
 
         try:
@@ -797,11 +1099,10 @@ class test_harness(object):
             raise error.Error('Machine does not have %s' % workvol)
 
         self.workdir = os.path.join(workvol, 'blkcgroup_test_tmp')
-        if not os.path.exists(self.workdir):
-            os.makedirs(self.workdir)
-        else:
-            # Remove all previous content from "workdir"s subdirectories.
-            utils.system('rm -rf %s/*' % self.workdir)
+        # Remove all previous content from "workdir", including dot files.
+        if os.path.lexists(self.workdir):
+            shutil.rmtree(self.workdir)
+        os.makedirs(self.workdir)
 
         # Get get the underlying device name where the workvol is located.
         if google_hacks:
@@ -832,7 +1133,8 @@ class test_harness(object):
             workers, allowed_error = experiment
             self.run_single_experiment(i, workers, seq_read_mb,
                                        kill_slower, timeout, allowed_error,
-                                       autotest_data)
+                                       autotest_data, full_cache_flush,
+                                       steady_state_secs)
 
         # We have to do file output after all the worker threads are done and we
         # won't create any more. Printing during score_experiment() caused
@@ -853,4 +1155,4 @@ class test_harness(object):
 
 
         # Cleanup.
-        utils.system('rm -rf %s' % self.workdir)
+        shutil.rmtree(self.workdir, ignore_errors=True)
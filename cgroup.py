@@ -32,12 +32,13 @@ def mount_point(subsystem):
     """
     if subsystem not in cached_mounts:
         cached_mounts[subsystem] = ''
-        for mounts in open('/proc/mounts').readlines():
-            name, mount_pt, fs, options, junk = mounts.split(None, 4)
-            if (fs == 'cgroup' and subsystem in options.split(',')  or
-                fs == 'cpuset' == subsystem):
-                    cached_mounts[subsystem] = mount_pt
-                    break
+        with open('/proc/mounts') as f:
+            for mounts in f:
+                name, mount_pt, fs, options, junk = mounts.split(None, 4)
+                if (fs == 'cgroup' and subsystem in options.split(',')  or
+                    fs == 'cpuset' == subsystem):
+                        cached_mounts[subsystem] = mount_pt
+                        break
 
     if cached_mounts[subsystem] == '':
         # Error out if no mount_point found.
@@ -121,7 +122,8 @@ class cgroup_accessor(object):
     def get_attr(self, attr, prefix='default'):
         """Get the value of a given cgorup attribute."""
         filename = self._attr_file(attr, prefix)
-        return [value.rstrip() for value in open(filename).readlines()]
+        with open(filename) as f:
+            return [value.rstrip() for value in f]
 
 
     def put_attr(self, attr, values, prefix='default'):
@@ -105,14 +105,8 @@ static int random_read(char *filename, off64_t count,
 	for (i = 0; i < count && !killed; ++i) {
 		offset = (((off64_t) rand()) % size) << ioSizeBits;
 
-		ret = lseek64(fd, offset, SEEK_SET);
-		if (ret < 0) {
-			fprintf(stderr, "seek failed: %s\n", strerror(errno));
-			return -1;
-		}
-
 		gettimeofday(&start_time, NULL);
-		ret = read(fd, buffer, (1 << ioSizeBits));
+		ret = pread64(fd, buffer, (1 << ioSizeBits), offset);
 		if (ret < 0) {
 			fprintf(stderr, "read failed: %s\n", strerror(errno));
 			return -1;